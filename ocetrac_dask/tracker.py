@@ -1,10 +1,7 @@
 import xarray as xr
 import numpy as np
-import scipy.ndimage
-from skimage.measure import regionprops_table 
-from dask_image.ndmeasure import label as label_dask
+import numba
 import dask.array as dsa
-from dask import persist
 from dask.base import is_dask_collection
 
 class Tracker:
@@ -19,6 +16,13 @@ class Tracker:
         self.xdim = xdim
         self.ydim = ydim   
         self.positive = positive
+
+        # Define structuring element (a disk), and its decomposition into rectangles, once for all frames
+        x = np.arange(-radius, radius+1)
+        x, y = np.meshgrid(x, x)
+        r = x**2+y**2 
+        se = r<radius**2
+        self._se_rects = np.array(_disk_decomposition(se), dtype=np.int64).reshape(-1, 2)
         
         if ((timedim, ydim, xdim) != da.dims):
             try:
@@ -31,6 +35,11 @@ class Tracker:
         
         if (mask == 0).all():
             raise ValueError('Found only zeros in `mask` input. The mask should indicate valid regions with values of 1')
+
+        # Closing then opening reaches 4 radii along x, which is periodic: beyond the x extent, it can only wrap
+        # within a single chunk
+        if len(da.chunks[da.get_axis_num(xdim)]) > 1 and 4*radius > da.sizes[xdim]:
+            raise ValueError(f'The structuring element reaches {4*radius} points in {xdim}, beyond its size of {da.sizes[xdim]}. Please keep {xdim} in a single chunk, and try again.')
         
             
     def track(self):
@@ -72,19 +81,15 @@ class Tracker:
         # Convert data to binary, define structuring element, and perform morphological closing then opening
         binary_images = self._morphological_operations()
 
-        # Apply mask
-        binary_images_with_mask  = self._apply_mask(binary_images)
-
-        # Filter area
-        area, min_area, binary_images_filtered, N_initial = self._filter_area(binary_images_with_mask)
+        # Apply mask (as part of the labelling) and filter area
+        area, min_area, labels_filtered, N_kept = self._filter_area(binary_images)
+        N_initial = area.size
 
-        # Label objects (using dask_label, *wraps at the same time*) -- connectivity now in time
-        labels_wrapped, N_final = label_dask(binary_images_filtered, structure=np.ones((3,3,3)), wrap_axes=(2,))
-        labels_wrapped, N_final = persist(labels_wrapped, N_final) # Persist both in memory...
-        N_final = N_final.compute()
-        labels_wrapped = xr.DataArray(labels_wrapped, coords=binary_images_filtered.coords, dims=binary_images_filtered.dims, attrs=binary_images_filtered.attrs)
-        
-        final_labels = labels_wrapped.where(labels_wrapped!=0, drop=False, other=np.nan)
+        # Link the objects in time. Each frame is already labelled (and wrapped in x), so rather than labelling
+        # the whole cube again, only the objects that touch in consecutive frames are joined
+        # The final labels are written in one pass, with the background already set to NaN
+        final_labels, N_final = self._link_time(labels_filtered, N_kept)
+        final_labels = final_labels.persist()
 
 
         ## Metadata
@@ -117,13 +122,8 @@ class Tracker:
 
     ### PRIVATE METHODS - not meant to be called by user ###
     
-    def _apply_mask(self, binary_images):
-        binary_images_with_mask = binary_images.where(self.mask==1, drop=False, other=0)
-        return binary_images_with_mask
-    
-
     def _morphological_operations(self): 
-        '''Converts xarray.DataArray to binary, defines structuring element, and performs morphological closing then opening.
+        '''Converts xarray.DataArray to binary, and performs morphological closing then opening with the structuring element.
         Parameters
         ----------
         da     : xarray.DataArray
@@ -133,68 +133,66 @@ class Tracker:
 
         '''
 
-        # Convert images to binary. All positive values == 1, otherwise == 0
+        # Convert images to binary in a single comparison. All positive (or negative) values == True, otherwise == False
         if self.positive == True:
-            bitmap_binary = self.da.where(self.da>0, drop=False, other=0)
+            bitmap_binary = self.da > 0
         
         elif self.positive == False:
-            bitmap_binary = self.da.where(self.da<0, drop=False, other=0)
-    
-        bitmap_binary = bitmap_binary.where(bitmap_binary==0, drop=False, other=1)
+            bitmap_binary = self.da < 0
 
-        # Define structuring element
         diameter = self.radius*2
-        x = np.arange(-self.radius, self.radius+1)
-        x, y = np.meshgrid(x, x)
-        r = x**2+y**2 
-        se = r<self.radius**2
+        se_rects = self._se_rects
+
+        # Let dask add the halos, so that (y, x) can also be chunked. Closing then opening reaches 4 radii (= 2*diameter)
+        # Only x is periodic: at the y boundaries, points outside are ignored by the kernels, so the y halo never
+        # needs to be larger than y itself
+        bitmap_binary = bitmap_binary.transpose(..., self.ydim, self.xdim)
+        ndim = bitmap_binary.ndim
+        depth = {ndim-2: min(2*diameter, bitmap_binary.shape[-2]), ndim-1: 2*diameter}
+        boundary = {ndim-2: 'none', ndim-1: 'periodic'}
+
+        # If x is a single chunk, wrap it within the block instead, which also works for halos larger than x
+        wrap = 0
+        if len(bitmap_binary.data.chunks[-1]) == 1:
+            wrap, depth[ndim-1], boundary[ndim-1] = 2*diameter, 0, 'none'
 
         def binary_open_close(bitmap_binary):
-            bitmap_binary_padded = np.pad(bitmap_binary,
-                                          ((diameter, diameter), (diameter, diameter)),
-                                          mode='wrap')
-            s1 = scipy.ndimage.binary_closing(bitmap_binary_padded, se, iterations=1)
-            s2 = scipy.ndimage.binary_opening(s1, se, iterations=1)
-            unpadded= s2[diameter:-diameter, diameter:-diameter]
-            return unpadded
-
-        mo_binary = xr.apply_ufunc(binary_open_close, bitmap_binary,
-                                   input_core_dims=[[self.ydim, self.xdim]],
-                                   output_core_dims=[[self.ydim, self.xdim]],
-                                   output_dtypes=[bitmap_binary.dtype],
-                                   vectorize=True,
-                                   dask='parallelized')
+            # Operates on a whole (time, y, x) tile at once, with a structuring element that is flat in time
+            if wrap == 0:
+                return _open_close_packed(bitmap_binary, se_rects)
+            pad_width = [(0, 0)] * (bitmap_binary.ndim-1) + [(wrap, wrap)]
+            padded = np.pad(bitmap_binary, pad_width, mode='wrap')
+            return _open_close_packed(padded, se_rects)[..., wrap:-wrap]
+
+        mo_data = dsa.map_overlap(binary_open_close, bitmap_binary.data,
+                                  depth=depth, boundary=boundary, dtype=bool)
+        mo_binary = bitmap_binary.copy(data=mo_data)
         return mo_binary
 
 
     def _filter_area(self, binary_images):
-        '''Calculate area with regionprops'''
+        '''Calculate area with np.bincount, frame by frame'''
         
         # Label time-independent in 2D (i.e. no time connectivity!) and wrap in xdim
-        connectivity = np.zeros((3,3,3))
-        connectivity[1,:,:] = 1
-        labels_wrapped, N_initial = label_dask(binary_images, structure=connectivity, wrap_axes=(2,))
-        labels_wrapped, N_initial = persist(labels_wrapped, N_initial) # Persist both in memory...
-        
-        N_initial = N_initial.compute()
-        labels_wrapped = xr.DataArray(labels_wrapped, coords=binary_images.coords, dims=binary_images.dims, attrs=binary_images.attrs)
-        
-        # Calculate Area of each object and keep objects larger than threshold
-        def regionprops_slice(labels):
-            props_slice = regionprops_table(labels.astype('int'), properties=['label', 'area'])
-            return props_slice
-        
-        props = xr.apply_ufunc(regionprops_slice, labels_wrapped,
-                input_core_dims=[[self.ydim, self.xdim]],
-                output_core_dims=[[]],
-                output_dtypes=[object],
-                vectorize=True,
-                dask='parallelized')
+        # Masked points are skipped by the labelling itself, rather than zeroed in a separate pass
+        labels = xr.apply_ufunc(_label_periodic_x, binary_images, self.mask==1,
+                                input_core_dims=[[self.ydim, self.xdim], [self.ydim, self.xdim]],
+                                output_core_dims=[[self.ydim, self.xdim]],
+                                output_dtypes=[np.int32],
+                                dask='parallelized',
+                                dask_gufunc_kwargs={'allow_rechunk': True})
+        labels = labels.persist()
+
+        # Calculate Area of each object (i.e. its pixel count), frame by frame
+        frame_areas = xr.apply_ufunc(_frame_areas, labels,
+                                     input_core_dims=[[self.ydim, self.xdim]],
+                                     output_dtypes=[object],
+                                     dask='parallelized')
+        frame_areas = frame_areas.persist()
         
-        props_da = xr.concat([xr.Dataset({key: (['label'], value) for key, value in item.items()}) for item in props.values], dim='label')
-        
-        labelprops = props_da['label']        
-        area = props_da['area']
+        # Objects keep their per-frame label, so no offsets ever need to be added to the labels
+        areas_list = list(frame_areas.values.ravel())
+        area = xr.DataArray(np.concatenate(areas_list), dims=['label'])
 
         if area.size == 0:
             raise ValueError(f'No objects were detected. Try changing radius or min_size_quartile parameters.')
@@ -202,13 +200,344 @@ class Tracker:
         min_area = np.percentile(area, self.min_size_quartile*100)
         print(f'minimum area: {min_area}') 
         
-        keep_labels = labelprops.where(area>=min_area, drop=True)
-        keep_where = labels_wrapped.isin(keep_labels)
-        out_labels = xr.where(~keep_where, 0, labels_wrapped)
-
-        # Convert labels to binary. All positive values == 1, otherwise == 0
-        binary_images_filtered = out_labels.where(out_labels==0, drop=False, other=1)
-
-        return area, min_area, binary_images_filtered, N_initial
-
-
+        # Keep objects larger than threshold. A per-frame look-up table from each label to its new (consecutive)
+        # label if kept, or else 0, removes small objects in a single gather, and leaves the frames labelled
+        keep = [item >= min_area for item in areas_list]
+        N_kept = np.array([item.sum() for item in keep], dtype=np.int64)
+        luts = np.empty(frame_areas.shape, dtype=object)
+        for idx, item in zip(np.ndindex(luts.shape), keep):
+            luts[idx] = np.concatenate([[0], np.where(item, np.cumsum(item), 0)]).astype(np.int32)
+        luts = frame_areas.copy(data=dsa.from_array(luts, chunks=frame_areas.data.chunks))
+
+        labels_filtered = xr.apply_ufunc(_relabel, labels, luts,
+                                         input_core_dims=[[self.ydim, self.xdim], []],
+                                         output_core_dims=[[self.ydim, self.xdim]],
+                                         output_dtypes=[np.int32],
+                                         dask='parallelized')
+
+        return area, min_area, labels_filtered, N_kept
+
+
+    def _link_time(self, labels, N_kept):
+        '''Join the objects of consecutive frames that touch (with 8-connectivity and periodic x) with a union-find'''
+
+        labels = labels.transpose(self.timedim, self.ydim, self.xdim)
+
+        # Pairs of touching labels between each frame and the next
+        data = labels.data
+        data_next = data[1:].rechunk(data[:-1].chunks)
+        links = dsa.map_blocks(_frame_links, data[:-1], data_next, drop_axis=[1, 2], dtype=object).compute()
+
+        # Objects are numbered globally by offsetting the labels of each frame, then joined and resolved to
+        # consecutive final labels
+        offsets = np.concatenate([[0], np.cumsum(N_kept)])
+        nodes_a = [pairs[:, 0] + offsets[t] for t, pairs in enumerate(links)]
+        nodes_b = [pairs[:, 1] + offsets[t+1] for t, pairs in enumerate(links)]
+        parent = np.arange(offsets[-1]+1, dtype=np.int32)
+        N_final = _union_pairs(parent, np.concatenate([[0]] + nodes_a), np.concatenate([[0]] + nodes_b), offsets[-1])
+
+        # Per-frame look-up table from each label to its final label, or NaN for the background
+        luts = np.empty(N_kept.size, dtype=object)
+        for t in range(N_kept.size):
+            luts[t] = parent[offsets[t]:offsets[t+1]+1].astype(np.float64)
+            luts[t][0] = np.nan
+        luts = xr.DataArray(dsa.from_array(luts, chunks=data.chunks[:1]), dims=[self.timedim])
+
+        final_labels = xr.apply_ufunc(_relabel, labels, luts, kwargs={'dtype': np.float64},
+                                      input_core_dims=[[self.ydim, self.xdim], []],
+                                      output_core_dims=[[self.ydim, self.xdim]],
+                                      output_dtypes=[np.float64],
+                                      dask='parallelized')
+
+        return final_labels, N_final
+
+
+def _frame_areas(labels):
+    '''Pixel count of each label (from 1) of each 2D image in a stack, as an object array of 1D arrays.'''
+    areas = np.empty(labels.shape[:-2], dtype=object)
+    for idx in np.ndindex(areas.shape):
+        areas[idx] = np.bincount(labels[idx].ravel())[1:]
+    return areas
+
+
+def _relabel(labels, luts, dtype=np.int32):
+    '''Map the labels of each 2D image in a stack through its own look-up table (an object array of 1D arrays).'''
+    out = np.empty(labels.shape, dtype=dtype)
+    for idx in np.ndindex(luts.shape):
+        out[idx] = luts[idx][labels[idx]]
+    return out
+
+
+def _frame_links(labels_a, labels_b):
+    '''Pairs of touching labels between two stacks of 2D label images, image by image, as an object array of
+    (n, 2) arrays. Labels touch if any of their points are neighbours with 8-connectivity and periodic x.
+    '''
+    links = np.empty(labels_a.shape[0], dtype=object)
+    for t in range(labels_a.shape[0]):
+        keys = np.unique(_touching_keys(labels_a[t], labels_b[t]))
+        links[t] = np.stack([keys >> 32, keys & 0xFFFFFFFF], axis=-1)
+    return links
+
+
+@numba.njit(nogil=True, cache=True)
+def _touching_keys(labels_a, labels_b):
+    '''Touching pairs of labels (a, b), encoded as (a << 32) | b. A pair may appear more than once.'''
+    ny, nx = labels_a.shape
+    keys = [np.int64(0) for _ in range(0)]
+    for j in range(ny):
+        last = np.int64(0)
+        for i in range(nx):
+            a = labels_a[j, i]
+            if a == 0:
+                continue
+            for jj in range(max(j-1, 0), min(j+2, ny)):
+                for di in (-1, 0, 1):
+                    b = labels_b[jj, (i+di) % nx]
+                    if b == 0:
+                        continue
+                    key = (np.int64(a) << 32) | np.int64(b)
+                    # Most neighbouring points repeat the same pair, so only changes are recorded
+                    if key != last:
+                        keys.append(key)
+                        last = key
+    return np.array(keys, dtype=np.int64)
+
+
+@numba.njit(nogil=True, cache=True)
+def _union_pairs(parent, nodes_a, nodes_b, n):
+    '''Join each pair of labels (nodes_a[k], nodes_b[k]), then resolve `parent` to consecutive labels.
+    Returns their number.
+    '''
+    for k in range(nodes_a.shape[0]):
+        _union(parent, nodes_a[k], nodes_b[k])
+    return _resolve(parent, n)
+
+
+def _label_periodic_x(images, mask):
+    '''Label a stack of 2D binary images (the last two axes) independently, with 8-connectivity and periodic x.
+    Only points where `mask` (broadcast against `images`) is True are labelled.
+    Labels are consecutive from 1 within each image.
+    '''
+    images = np.asarray(images, dtype=bool)
+    mask = np.broadcast_to(np.asarray(mask, dtype=bool), images.shape)
+    shape_3d = (-1,) + images.shape[-2:]
+    labels = np.zeros(images.shape, dtype=np.int32)
+    _label_stack(images.reshape(shape_3d), mask.reshape(shape_3d), labels.reshape(shape_3d))
+    return labels
+
+
+@numba.njit(nogil=True, cache=True)
+def _label_stack(images, mask, labels):
+    for t in range(images.shape[0]):
+        _label_2d(images[t], mask[t], labels[t])
+
+
+@numba.njit(nogil=True, cache=True)
+def _label_2d(image, mask, labels):
+    '''Two-pass connected-component labelling of one (masked) image into `labels`. Returns the number of labels.
+    Provisional labels are joined with a union-find while scanning, then joined across the periodic x boundary,
+    and finally resolved to consecutive labels.
+    '''
+    ny, nx = image.shape
+    parent = np.zeros(ny*nx+1, dtype=np.int32)
+    n = 0
+
+    for j in range(ny):
+        for i in range(nx):
+            if not (image[j, i] and mask[j, i]):
+                continue
+            current = 0
+            # Neighbours already scanned: (j, i-1), (j-1, i-1), (j-1, i), (j-1, i+1)
+            for dj, di in ((0, -1), (-1, -1), (-1, 0), (-1, 1)):
+                jj = j + dj
+                ii = i + di
+                if jj < 0 or ii < 0 or ii >= nx or labels[jj, ii] == 0:
+                    continue
+                if current == 0:
+                    current = labels[jj, ii]
+                else:
+                    _union(parent, current, labels[jj, ii])
+            if current == 0:
+                n += 1
+                parent[n] = n
+                current = n
+            labels[j, i] = current
+
+    # (j, 0) touches (j-1, -1), (j, -1) and (j+1, -1) across the boundary
+    if nx > 1:
+        for j in range(ny):
+            if labels[j, 0] == 0:
+                continue
+            for jj in range(max(j-1, 0), min(j+2, ny)):
+                if labels[jj, nx-1] != 0:
+                    _union(parent, labels[j, 0], labels[jj, nx-1])
+
+    n_final = _resolve(parent, n)
+
+    for j in range(ny):
+        for i in range(nx):
+            labels[j, i] = parent[labels[j, i]]
+    return n_final
+
+
+@numba.njit(nogil=True, cache=True)
+def _resolve(parent, n):
+    '''Map `parent` in place from provisional labels 1..n to consecutive final labels. Returns their number.'''
+    # Every parent is smaller than its child, so one ascending pass resolves the roots
+    n_final = 0
+    for k in range(1, n+1):
+        if parent[k] == k:
+            n_final += 1
+            parent[k] = n_final
+        else:
+            parent[k] = parent[parent[k]]
+    return n_final
+
+
+@numba.njit(nogil=True, cache=True)
+def _union(parent, x, y):
+    '''Join the sets of labels x and y with Rem's algorithm (the root is always the smallest label).'''
+    while parent[x] != parent[y]:
+        if parent[x] < parent[y]:
+            x, y = y, x
+        if x == parent[x]:
+            parent[x] = parent[y]
+            return
+        z = parent[x]
+        parent[x] = parent[y]
+        x = z
+
+
+def _disk_decomposition(se):
+    '''Decompose a disk structuring element into the rectangles whose union is exactly `se`.
+    Row k of the disk (counted from the centre) has half-width w_k, which never grows with k, so the disk
+    is the union of the (2k+1, 2w_k+1) rectangles. Only the ~radius rectangles where w_k shrinks are kept.
+    '''
+    centre = se.shape[0]//2
+    half_widths = se[centre:].sum(axis=1)//2
+    rects = []
+    for k, w in enumerate(half_widths):
+        if se[centre+k].any() and (k == centre or not se[centre+k+1].any() or half_widths[k+1] < w):
+            rects.append((2*k+1, 2*w+1))
+    return rects
+
+
+def _open_close_packed(bitmap, rects):
+    '''Morphological closing then opening of a stack of 2D binary images (the last two axes), by a disk decomposed
+    into `rects` with `_disk_decomposition`. Points outside the images are ignored (i.e. treated as 0 when dilating
+    and 1 when eroding).
+    The images are bit-packed along x into uint64 words (pixel i is bit i%64 of word i//64), so that every word
+    operation processes 64 pixels at once, and are only unpacked again at the end.
+    '''
+    ny, nx = bitmap.shape[-2:]
+    n_words = -(-nx//64)
+
+    packed_u8 = np.packbits(np.asarray(bitmap, dtype=bool), axis=-1, bitorder='little')
+    padded_u8 = np.zeros(packed_u8.shape[:-1] + (8*n_words,), dtype=np.uint8)
+    padded_u8[..., :packed_u8.shape[-1]] = packed_u8
+    packed = padded_u8.view('<u8').astype(np.uint64, copy=False).reshape((-1, ny, n_words))
+
+    # Bits of the last word that lie beyond the image, which are kept at 0
+    last_mask = np.uint64(2**64-1) if nx % 64 == 0 else np.uint64(2**(nx % 64)-1)
+    opened = _open_close_packed_stack(packed, rects, last_mask)
+
+    opened_u8 = opened.astype('<u8', copy=False).view(np.uint8)
+    unpacked = np.unpackbits(opened_u8, axis=-1, count=nx, bitorder='little')
+    return unpacked.reshape(bitmap.shape).astype(bool)
+
+
+@numba.njit(nogil=True, cache=True)
+def _open_close_packed_stack(packed, rects, last_mask):
+    opened = np.empty_like(packed)
+
+    # Scratch images, allocated once per block rather than for every frame and operation
+    closed = np.empty(packed.shape[1:], dtype=np.uint64)
+    dilated = np.empty_like(closed)
+    inverted = np.empty_like(closed)
+    a = np.empty_like(closed)
+    b = np.empty_like(closed)
+
+    for t in range(packed.shape[0]):
+        _dilate_packed(packed[t], rects, last_mask, dilated, a, b)
+        _erode_packed(dilated, rects, last_mask, closed, inverted, a, b)
+        _erode_packed(closed, rects, last_mask, dilated, inverted, a, b)
+        _dilate_packed(dilated, rects, last_mask, opened[t], a, b)
+    return opened
+
+
+@numba.njit(nogil=True, cache=True)
+def _erode_packed(image, rects, last_mask, eroded, inverted, a, b):
+    '''Erode as the complement of the dilated complement, so that the border is ignored.'''
+    inverted[:] = ~image
+    inverted[:, -1] &= last_mask
+    _dilate_packed(inverted, rects, last_mask, eroded, a, b)
+    eroded[:] = ~eroded
+    eroded[:, -1] &= last_mask
+
+
+@numba.njit(nogil=True, cache=True)
+def _dilate_packed(image, rects, last_mask, dilated, a, b):
+    '''Dilate a bit-packed image by the union of the rectangles (height, width) in `rects`, into `dilated`.
+    Each rectangle is separable, and each direction is dilated in O(log size) shift-and-OR steps, by doubling
+    the covered range every step. `a` and `b` are scratch images.
+    '''
+    dilated[:] = 0
+    for r in range(rects.shape[0]):
+        half_height = rects[r, 0]//2
+        half_width = rects[r, 1]//2
+        a[:] = image
+        covered = 0
+        while covered < half_width:
+            step = min(covered+1, half_width-covered)
+            _shift_or_x(a, step, b)
+            b[:, -1] &= last_mask
+            a, b = b, a
+            covered += step
+        covered = 0
+        while covered < half_height:
+            step = min(covered+1, half_height-covered)
+            _shift_or_y(a, step, b)
+            a, b = b, a
+            covered += step
+        dilated |= a
+
+
+@numba.njit(nogil=True, cache=True)
+def _shift_or_x(a, step, out):
+    '''out = a | (a shifted by +step pixels in x) | (a shifted by -step pixels in x), carrying bits across words.'''
+    ny, nw = a.shape
+    q = step//64
+    s = np.uint64(step % 64)
+    s_carry = np.uint64(64 - step % 64)
+    for j in range(ny):
+        for k in range(nw):
+            v = a[j, k]
+            if k-q >= 0:
+                if s == 0:
+                    v |= a[j, k-q]
+                else:
+                    v |= a[j, k-q] << s
+                    if k-q-1 >= 0:
+                        v |= a[j, k-q-1] >> s_carry
+            if k+q < nw:
+                if s == 0:
+                    v |= a[j, k+q]
+                else:
+                    v |= a[j, k+q] >> s
+                    if k+q+1 < nw:
+                        v |= a[j, k+q+1] << s_carry
+            out[j, k] = v
+
+
+@numba.njit(nogil=True, cache=True)
+def _shift_or_y(a, step, out):
+    '''out = a | (a shifted by +step rows) | (a shifted by -step rows).'''
+    ny, nw = a.shape
+    for j in range(ny):
+        for k in range(nw):
+            v = a[j, k]
+            if j-step >= 0:
+                v |= a[j-step, k]
+            if j+step < ny:
+                v |= a[j+step, k]
+            out[j, k] = v
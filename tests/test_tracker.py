@@ -0,0 +1,154 @@
+import itertools
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from ocetrac_dask import Tracker
+from ocetrac_dask.tracker import _disk_decomposition, _label_periodic_x, _open_close_packed
+
+
+def label_periodic_x_reference(image):
+    """Label `image` with full connectivity (8 in 2D, 26 in 3D), then join the labels across the periodic
+    last axis, i.e. points in the first column touching points in the last column."""
+    labels, n = ndimage.label(image, structure=np.ones((3,) * image.ndim))
+    first, last = labels[..., 0], labels[..., -1]
+    pairs = []
+    for offset in itertools.product((-1, 0, 1), repeat=image.ndim - 1):
+        src = tuple(slice(max(-d, 0), first.shape[i] - max(d, 0)) for i, d in enumerate(offset))
+        dst = tuple(slice(max(d, 0), first.shape[i] - max(-d, 0)) for i, d in enumerate(offset))
+        touching = (first[src] != 0) & (last[dst] != 0)
+        pairs.append(np.stack([first[src][touching], last[dst][touching]]))
+    pairs = np.concatenate(pairs, axis=1)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(n + 1, n + 1))
+    _, components = connected_components(graph, directed=False)
+    # Renumber the joined components consecutively from 1, with 0 for the background
+    _, joined = np.unique(components[labels[labels != 0]], return_inverse=True)
+    out = np.zeros_like(labels)
+    out[labels != 0] = joined.ravel() + 1
+    return out
+
+
+def open_close_reference(image, se):
+    """Closing then opening of a 2D image with scipy, ignoring points outside the image (i.e. border 0 when
+    dilating and 1 when eroding), which binary_closing/binary_opening cannot express with one border value."""
+    closed = ndimage.binary_erosion(ndimage.binary_dilation(image, se), se, border_value=1)
+    return ndimage.binary_dilation(ndimage.binary_erosion(closed, se, border_value=1), se)
+
+
+def disk(radius):
+    x = np.arange(-radius, radius + 1)
+    x, y = np.meshgrid(x, x)
+    return x**2 + y**2 < radius**2
+
+
+def assert_same_partition(labels, expected):
+    """Both label arrays split the same points into the same objects, whatever the label values."""
+    np.testing.assert_array_equal(labels != 0, expected != 0)
+    pairs = np.unique(np.stack([labels[labels != 0], expected[expected != 0]]), axis=1)
+    assert len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("nx", [1, 2, 37, 64])
+def test_label_periodic_x(seed, nx):
+    rng = np.random.default_rng(seed)
+    images = rng.random((3, 25, nx)) < rng.uniform(0.2, 0.6)
+    mask = rng.random((25, nx)) < 0.9
+
+    labels = _label_periodic_x(images, mask)
+
+    assert labels.dtype == np.int32
+    for t in range(images.shape[0]):
+        expected = label_periodic_x_reference(images[t] & mask)
+        assert_same_partition(labels[t], expected)
+        # Labels are consecutive from 1 in each image
+        np.testing.assert_array_equal(np.unique(labels[t][labels[t] != 0]), np.arange(1, expected.max() + 1))
+
+
+@pytest.mark.parametrize("radius", [1, 2, 3, 5, 8, 13])
+@pytest.mark.parametrize("nx", [37, 64, 100, 130])
+def test_open_close_packed(radius, nx):
+    rng = np.random.default_rng(radius * nx)
+    images = ndimage.gaussian_filter(rng.standard_normal((3, 40, nx)), (0, 2, 2), mode="wrap") > 0
+
+    # As in Tracker: a disk, and x padded periodically by the 4 radii that closing then opening reaches
+    se = disk(radius)
+    rects = np.array(_disk_decomposition(se), dtype=np.int64).reshape(-1, 2)
+    pad = 4 * radius
+    padded = np.pad(images, ((0, 0), (0, 0), (pad, pad)), mode="wrap")
+
+    opened = _open_close_packed(padded, rects)
+    opened_unpadded = _open_close_packed(images, rects)
+
+    assert opened.dtype == bool
+    for t in range(images.shape[0]):
+        expected = open_close_reference(padded[t], se)
+        np.testing.assert_array_equal(opened[t, :, pad:-pad], expected[:, pad:-pad])
+        # Without the padding, the x boundaries are ignored just like the y boundaries
+        np.testing.assert_array_equal(opened_unpadded[t], open_close_reference(images[t], se))
+
+
+def track_reference(data, mask, radius, min_size_quartile):
+    """What Tracker.track() should label: morphology on the periodic frames, then masked 2D labels, filtered by
+    area, then the 3x3x3-connected labels of what remains, wrapped in x."""
+    se = disk(radius)
+    pad = 4 * radius
+    binary = np.stack([open_close_reference(np.pad(frame, ((0, 0), (pad, pad)), mode="wrap"), se)[:, pad:-pad]
+                       for frame in data > 0]) & mask
+    frame_labels = np.stack([label_periodic_x_reference(frame) for frame in binary])
+    areas = [np.bincount(frame.ravel())[1:] for frame in frame_labels]
+    min_area = np.percentile(np.concatenate(areas), min_size_quartile * 100)
+    kept = np.stack([np.concatenate([[False], area >= min_area])[frame]
+                     for area, frame in zip(areas, frame_labels)])
+    return label_periodic_x_reference(kept)
+
+
+def track(data, mask, chunks, radius, min_size_quartile):
+    da = xr.DataArray(data, dims=("time", "lat", "lon")).chunk(chunks)
+    return Tracker(da, xr.DataArray(mask.astype(float), dims=("lat", "lon")), radius=radius,
+                   min_size_quartile=min_size_quartile, timedim="time", xdim="lon", ydim="lat").track()
+
+
+def assert_same_tracks(labels, expected):
+    values = np.nan_to_num(labels.values).astype(int)
+    assert_same_partition(values, expected)
+    assert labels.attrs["final objects tracked"] == expected.max()
+    np.testing.assert_array_equal(np.unique(values[values != 0]), np.arange(1, expected.max() + 1))
+
+
+# Radius 1 leaves the images unchanged, so the noise is labelled as is, with many diagonal contacts
+@pytest.mark.parametrize("radius, min_size_quartile, sigma, threshold", [(1, 0, 0, 1.8), (3, 0.5, 1, 0.3)])
+@pytest.mark.parametrize("chunks", [{"time": 2}, {"time": 3, "lat": 20, "lon": 25}])
+def test_track(radius, min_size_quartile, sigma, threshold, chunks):
+    rng = np.random.default_rng(0)
+    data = ndimage.gaussian_filter(rng.standard_normal((7, 40, 60)), (0, sigma, sigma), mode="wrap") - threshold
+    mask = rng.random((40, 60)) < 0.95
+
+    labels = track(data, mask, chunks, radius, min_size_quartile)
+
+    assert_same_tracks(labels, track_reference(data, mask, radius, min_size_quartile))
+
+
+# Closing then opening reaches 4 radii, i.e. beyond both the 40 points in y and the 60 in x
+@pytest.mark.parametrize("chunks", [{"time": 2}, {"time": 3, "lat": 20}])
+def test_track_large_radius(chunks):
+    rng = np.random.default_rng(0)
+    data = ndimage.gaussian_filter(rng.standard_normal((7, 40, 60)), (0, 6, 6), mode="wrap")
+    mask = rng.random((40, 60)) < 0.95
+
+    labels = track(data, mask, chunks, 16, 0)
+
+    expected = track_reference(data, mask, 16, 0)
+    assert expected.max() > 0
+    assert_same_tracks(labels, expected)
+
+
+def test_track_large_radius_chunked_x():
+    data = np.ones((7, 40, 60))
+    with pytest.raises(ValueError, match="single chunk"):
+        track(data, np.ones((40, 60), dtype=bool), {"time": 2, "lon": 30}, 16, 0)